@@ -1,7 +1,11 @@
-from PIL import Image
+from PIL import Image, ImageChops, ImageFilter, ImageMath
 import zipfile
 import json
 import os, sys, shutil
+import itertools
+import random
+import math
+import concurrent.futures
 
 # RGB codes to tile index
 rockies_tiledef = {
@@ -66,6 +70,12 @@ urban_tile_rotation = {
 }
 default_autocliff_diff = 50 # roughly 35°
 default_flat_cliff_diff = 30
+default_error_list_count = 10 # coordinates listed per error type
+error_unknown_color = (255,0,255,255)
+error_cliff_color = (255,64,64,255)
+preview_cliff_color = (60,40,30)
+default_gate_max_length = 8 # longest suggested gateway, in tiles
+gate_color = (64,255,64,255)
 env_tiledef = {
 	"r": rockies_tiledef,
 	"u": urban_tiledef,
@@ -95,35 +105,47 @@ def num_to_32bits(num):
 	b3 = int(num&0x000000ff)
 	return bytearray([b3,b2,b1,b0])
 
-def read_heightmap(filename):
-	"""Read heightmap in filename and return a 2-dimensional array of height"""
+def plane_to_image(m):
+	"""Get a L image from a 2-dimensional array of 0-255 values"""
+	# Columns are contiguous in the array, build the transposed image from them at once
+	return Image.frombytes('L', (len(m[0]), len(m)), bytes(itertools.chain.from_iterable(m))).transpose(Image.TRANSPOSE)
+
+def image_to_plane(img):
+	"""Get a 2-dimensional array from the first channel of img"""
+	height = img.size[1]
+	data = img.getchannel(0).transpose(Image.TRANSPOSE).tobytes()
+	return [list(data[x * height:(x + 1) * height]) for x in range(img.size[0])]
+
+def log_message(message, log=None):
+	"""Print message, or append it to log when set"""
+	if log is None:
+		print(message)
+	else:
+		log.append(message)
+
+def read_image(filename, name, log=None):
+	"""Open the png of a map plane and decode its pixels, return None when it cannot be parsed"""
 	try:
 		img = Image.open(filename)
+		img.load()
 	except FileNotFoundError:
-		print("File %s not found"%filename)
+		log_message("File %s not found"%filename, log)
 		return
-	except Error:
-		print("Error reading %s"%filename)
+	except OSError:
+		log_message("Error reading %s"%filename, log)
 		return
-	mode = img.mode
-	width,height = img.size
-	heights = []
-	for x in range(width):
-		heights.append([])
-		for y in range(height):
-			heights[x].append(0)
-	print("Reading heightmap %s as %s" % (filename, mode))
-	if mode != "RGB" and mode != "RGBA" and mode != "L":
-		print("Cannot parse heightmap, accepting only RGB, RGBA or L (greyscale)")
+	log_message("Reading %s %s as %s" % (name, filename, img.mode), log)
+	if img.mode != "RGB" and img.mode != "RGBA" and img.mode != "L":
+		log_message("Cannot parse %s, accepting only RGB, RGBA or L (greyscale)"%name, log)
 		return
-	for y in range(height):
-		for x in range(width):
-			px = img.getpixel((x, y))
-			# px is a tuple of values for each channels
-			heights[x][y] = px[0]
-		#end-for
-	#end-for
-	return heights
+	return img
+
+def read_heightmap(filename):
+	"""Read heightmap in filename and return a 2-dimensional array of height"""
+	img = read_image(filename, "heightmap")
+	if not img:
+		return
+	return image_to_plane(img)
 
 def map_to_bytes(m):
 	"""Convert a map to a linear byte array"""
@@ -139,13 +161,6 @@ def map_to_bytes(m):
 	return bytes
 
 
-def px_to_tile(px, tiledef):
-	"""Get the tile index from a pixel color"""
-	rgb = (px[0], px[1], px[2])
-	if not rgb in tiledef:
-		return
-	return tiledef[rgb]
-
 def tile_to_cliff(t, cliffdef, cliff_type):
 	"""Get the cliff tile index from a tile index"""
 	if not t in cliffdef:
@@ -154,85 +169,101 @@ def tile_to_cliff(t, cliffdef, cliff_type):
 		return
 	return cliffdef[t][cliff_type]
 
-def px_as_boolean(px, mode):
-	if mode == "RGBA":
-		return px[3] > 16 # alpha detection
-	elif mode == "RGB":
-		return px[0] + px[1] + px[2] > 16 # not black
+def image_to_booleans(img):
+	"""Get a 2-dimensional array telling which pixels of a cliffmap or gatemap are set"""
+	if img.mode == "RGBA":
+		channel = img.getchannel('A') # alpha detection
+	elif img.mode == "RGB":
+		# not black, the sum is clipped but only compared to 16
+		channel = ImageChops.add(ImageChops.add(img.getchannel('R'), img.getchannel('G')), img.getchannel('B'))
 	else:
-		return px[0] > 16 # not black either
+		channel = img.getchannel(0) # not black either
+	return [[v > 16 for v in column] for column in image_to_plane(channel)]
 
-def read_tilemap(tilefilename, clifffilename, env, heights):
-	"""Get an array of tile indexes from the tilemap stored in tilefilename mixed with clifffilename"""
-	try:
-		timg = Image.open(tilefilename)
-	except FileNotFoundError:
-		print("File %s not found"%tilefilename)
-		return
-	except Error:
-		print("Error reading %s"%tilefilename)
-		return
-	try:
-		cimg = Image.open(clifffilename)
-	except FileNotFoundError:
-		print("File %s not found"%clifffilename)
-		return
-	except Error:
-		print("Error reading %s"%clifffilename)
-		return
-	tmode = timg.mode
-	cmode = cimg.mode
+def image_to_tiles(timg, cliffs, env, heights, errorfilename=None, errors=None, log=None):
+	"""Get an array of tile indexes from the tilemap image timg mixed with the cliffs array
+	Unknown tiles and incompatible cliffs are highlighted in errorfilename when set
+	and their coordinates are stored in errors["tiles"] and errors["cliffs"] when errors is a dict"""
 	width,height = timg.size
-	if width != cimg.size[0] or height != cimg.size[1]:
-		print("Tile map and cliff map are not the same size")
+	if width != len(cliffs) or height != len(cliffs[0]):
+		log_message("Tile map and cliff map are not the same size", log)
 		return
+	# Coordinates of unknown tiles and incompatible cliffs, in reading order
+	terrors = []
+	cerrors = []
+	tiledef = env_tiledef[env[0]]
+	data = timg.convert('RGB').tobytes()
+	pixel_tiles = [tiledef.get(rgb) for rgb in zip(data[0::3], data[1::3], data[2::3])]
+	tiles = classify_tiles(lambda x, y: pixel_tiles[y * width + x], lambda x, y: cliffs[x][y],
+		width, height, env, heights, terrors, cerrors)
+	print_tile_errors(terrors, "Error(s) while reading tilemap: unknown tile(s)", log=log)
+	print_tile_errors(cerrors, "Error(s) while reading cliffmap: incompatible base tile(s)", log=log)
+	if errors != None:
+		errors["tiles"] = terrors
+		errors["cliffs"] = cerrors
+	if errorfilename and (terrors or cerrors):
+		write_errormap(errorfilename, timg, terrors, cerrors)
+		log_message("Errors highlighted in %s"%errorfilename, log)
+	return tiles
+
+def classify_tiles(get_tile, is_cliff, width, height, env, heights, terrors, cerrors):
+	"""Get an array of tile indexes from get_tile(x, y) returning the base tile index (None when unknown)
+	and is_cliff(x, y), appending unknown tiles and incompatible cliffs coordinates to terrors and cerrors"""
 	tiles = []
 	for x in range(width):
 		tiles.append([])
 		for y in range(height):
 			tiles[x].append(0)
-	terror = False
-	cerror = False
-	print("Reading tilemap %s as %s" % (tilefilename, tmode))
-	print("Reading cliffmap %s as %s" % (clifffilename, cmode))
-	if tmode != "RGB" and tmode != "RGBA" and tmode != "L":
-		print("Cannot parse tilemap, accepting only RGB, RGBA or L (greyscale)")
-		return
-	if cmode != "RGB" and cmode != "RGBA" and cmode != "L":
-		print("Cannot parse cliffmap, accepting only RGB, RGBA or L (greyscale)")
-		return
-	tiledef = env_tiledef[env[0]]
 	cliffdef = env_cliffdef[env[0]]
 	for y in range(height-1):
 		for x in range(width-1):
-			px = timg.getpixel((x, y))
-			tile = px_to_tile(px, tiledef)
-			cpx = cimg.getpixel((x,y))
-			iscliff = px_as_boolean(cpx, cmode)
-			if not tile:
+			tile = get_tile(x, y)
+			iscliff = is_cliff(x, y)
+			# tile 0 is a known color, only None is unknown
+			if tile is None:
 				if iscliff:
 					cliff_type = get_cliff_type(get_tile_height(heights, x, y))[0]
 					tiles[x][y] = cliffdef['default'][cliff_type]
-				terror = True
+				terrors.append((x,y))
 			else:
+				basetile = tile
 				if iscliff:
 					cliff_type = get_cliff_type(get_tile_height(heights, x, y))[0]
 					tile = tile_to_cliff(tile, cliffdef, cliff_type)
-				if not tile:
-					tiles[x][y] = cliffdef['default']["straight"]
-					cerror = True
+				if tile is None:
+					# Tile 0 used to take the unknown tile path, keep its default texture
+					if basetile == 0:
+						tiles[x][y] = cliffdef['default'][cliff_type]
+					else:
+						tiles[x][y] = cliffdef['default']["straight"]
+					cerrors.append((x,y))
 				else:
 					tiles[x][y] = tile
 				#if-else-end
 			#if-else-end
 		#end-for
 	#end-for
-	if terror:
-		print("Error(s) while reading tilemap: unknown tile(s)")
-	if cerror:
-		print("Error(s) while reading cliffmap: incompatible base tile(s)")
 	return tiles
 
+def print_tile_errors(errors, message, count=default_error_list_count, log=None):
+	"""Print the number of errors with the first coordinates"""
+	if not errors:
+		return
+	coords = " ".join(["%d,%d"%(x,y) for (x,y) in errors[:count]])
+	if len(errors) > count:
+		coords = coords + " ..."
+	log_message("%s: %d at %s"%(message, len(errors), coords), log)
+
+def write_errormap(filename, timg, terrors, cerrors):
+	"""Write the tilemap dimmed with unknown tiles and incompatible cliffs highlighted"""
+	errimg = timg.convert('RGBA').point(lambda v: v//4)
+	errimg.putalpha(255)
+	for (x,y) in terrors:
+		errimg.putpixel((x,y), error_unknown_color)
+	for (x,y) in cerrors:
+		errimg.putpixel((x,y), error_cliff_color)
+	errimg.save(filename)
+
 def get_tile_height(heights, x, y):
 	return [heights[x][y], heights[x+1][y], heights[x+1][y+1], heights[x][y+1]]
 
@@ -279,25 +310,15 @@ def get_cliff_type(tile_heights):
 			return ("corner", 180)
 
 
-def cliff_to_rotbytes(clifffilename, env, heights, tiles):
+def cliffs_to_rotbytes(is_cliff, width, height, env, heights, tiles):
 	# Rotation for the second byte
 	# Only cliffs are affected, ground textures are not rotated anyway
 	# mask is 0x30 = 00110000, 0 = not rotated, 1 = 90°, 2 = 180°, 3 = 270
-	try:
-		cimg = Image.open(clifffilename)
-	except FileNotFoundError:
-		print("File %s not found"%clifffilename)
-		return
-	except Error:
-		print("Error reading %s"%clifffilename)
-		return
-	cmode = cimg.mode
-	width,height = cimg.size
 	bytes = []
 	tile_rotation = env_tilerot[env[0]]
 	for y in range(height-1):
 		for x in range(width-1):
-			if px_as_boolean(cimg.getpixel((x,y)), cmode):
+			if is_cliff(x, y):
 				if x == width - 1 or y == height -1:
 					bytes.append(0x00)
 				else:
@@ -320,24 +341,24 @@ def cliff_to_rotbytes(clifffilename, env, heights, tiles):
 	# for y range end
 	return bytes
 
-def find_gate(img, mode, startx, starty, width, height):
+def find_gate(gatepx, startx, starty, width, height):
 	gate = {"startx": startx, "starty": starty}
 	x = startx
 	y = starty
 	endx = x
 	endy = y
-	if not px_as_boolean(img.getpixel((x,y)), mode):
+	if not gatepx[x][y]:
 		return None
 	# Gates are only lines, not rectangles. Check the longest path.
 	# Find gate width
 	x = x+1
-	while px_as_boolean(img.getpixel((x,starty)), mode) and x < width:
+	while x < width and gatepx[x][starty]:
 		x = x+1
 	endx = x-1
 	width = endx - startx
 	# Find gate height
 	y = y+1
-	while px_as_boolean(img.getpixel((startx,y)), mode) and y < height:
+	while y < height and gatepx[startx][y]:
 		y = y+1
 	endy = y-1
 	height = endy - starty
@@ -349,25 +370,17 @@ def find_gate(img, mode, startx, starty, width, height):
 		gate['endy'] = endy
 	return gate
 
-def gatemap_to_gates(gatefilename):
-	try:
-		img = Image.open(gatefilename)
-	except FileNotFoundError:
-		print("File %s not found, ignoring gateways"%gatefilename)
-		return []
-	except Error:
-		print("Error reading %s"%gatefilename)
-		return
-	mode = img.mode
+def image_to_gates(img):
+	"""Get the gateways drawn in the gatemap image img"""
+	gatepx = image_to_booleans(img)
 	width,height = img.size
 	gates = []
 	px_read = {}
-	print("Reading gatemap %s as %s" % (gatefilename, mode))
 	for y in range(height-1):
 		for x in range(width-1):
 			if "%d-%d"%(x,y) in px_read:
 				continue
-			gate = find_gate(img, mode, x, y, width, height)
+			gate = find_gate(gatepx, x, y, width, height)
 			if gate:
 				gates.append(gate)
 				for gx in range(gate["startx"], gate["endx"]+1):
@@ -380,6 +393,201 @@ def gatemap_to_gates(gatefilename):
 	# for y range end
 	return gates
 
+def get_cliff_tiles(env):
+	"""Get the set of cliff tile indexes of an environment"""
+	cliff_tiles = set()
+	for cliffs in env_cliffdef[env[0]].values():
+		cliff_tiles.update(cliffs.values())
+	return cliff_tiles
+
+def get_blocked_tiles(tiles, env):
+	"""Get a 2-dimensional array telling if each tile is not passable: cliffs and the map border"""
+	width = len(tiles) - 1
+	height = len(tiles[0]) - 1
+	cliff_tiles = get_cliff_tiles(env)
+	blocked = []
+	for x in range(width):
+		blocked.append([])
+		for y in range(height):
+			border = x == 0 or y == 0 or x == width - 1 or y == height - 1
+			blocked[x].append(border or tiles[x][y] in cliff_tiles)
+	return blocked
+
+def distance_transform(blocked):
+	"""Get the chessboard distance of each tile to the closest blocked tile, in two passes"""
+	width = len(blocked)
+	height = len(blocked[0])
+	far = width + height
+	dist = []
+	for x in range(width):
+		dist.append([0 if blocked[x][y] else far for y in range(height)])
+	for y in range(height):
+		for x in range(width):
+			if dist[x][y]:
+				d = dist[x][y]
+				if x > 0:
+					d = min(d, dist[x-1][y] + 1)
+					if y > 0:
+						d = min(d, dist[x-1][y-1] + 1)
+				if y > 0:
+					d = min(d, dist[x][y-1] + 1)
+					if x < width - 1:
+						d = min(d, dist[x+1][y-1] + 1)
+				dist[x][y] = d
+		#end-for
+	#end-for
+	for y in range(height-1, -1, -1):
+		for x in range(width-1, -1, -1):
+			if dist[x][y]:
+				d = dist[x][y]
+				if x < width - 1:
+					d = min(d, dist[x+1][y] + 1)
+					if y < height - 1:
+						d = min(d, dist[x+1][y+1] + 1)
+				if y < height - 1:
+					d = min(d, dist[x][y+1] + 1)
+					if x > 0:
+						d = min(d, dist[x-1][y+1] + 1)
+				dist[x][y] = d
+		#end-for
+	#end-for
+	return dist
+
+def get_blocked_regions_size(blocked):
+	"""Get the size of the 8-connected blocked region containing each tile, 0 for passable tiles"""
+	width = len(blocked)
+	height = len(blocked[0])
+	sizes = []
+	for x in range(width):
+		sizes.append([0] * height)
+	for x in range(width):
+		for y in range(height):
+			if not blocked[x][y] or sizes[x][y]:
+				continue
+			region = [(x, y)]
+			sizes[x][y] = -1
+			i = 0
+			while i < len(region):
+				rx, ry = region[i]
+				for nx in range(max(0, rx-1), min(width, rx+2)):
+					for ny in range(max(0, ry-1), min(height, ry+2)):
+						if blocked[nx][ny] and not sizes[nx][ny]:
+							sizes[nx][ny] = -1
+							region.append((nx, ny))
+				i = i + 1
+			for (rx, ry) in region:
+				sizes[rx][ry] = len(region)
+		#end-for
+	#end-for
+	return sizes
+
+def get_runs(blocked, horizontal):
+	"""Get the first and last tile of the passable line containing each tile, horizontally or vertically"""
+	width = len(blocked)
+	height = len(blocked[0])
+	runs = []
+	for x in range(width):
+		runs.append([None] * height)
+	lines = range(height) if horizontal else range(width)
+	length = width if horizontal else height
+	for l in lines:
+		start = None
+		for i in range(length + 1):
+			x, y = (i, l) if horizontal else (l, i)
+			if i < length and not blocked[x][y]:
+				if start == None:
+					start = i
+				continue
+			if start != None:
+				for j in range(start, i):
+					if horizontal:
+						runs[j][l] = (start, i - 1)
+					else:
+						runs[l][j] = (start, i - 1)
+				start = None
+		#end-for
+	#end-for
+	return runs
+
+def is_passage_side(runs, blocked, x, y, dx, dy, length, probe):
+	"""Tell if the area next to a gate opens wider than the gate when walking away from it"""
+	width = len(blocked)
+	height = len(blocked[0])
+	for k in range(1, probe + 1):
+		px = x + dx * k
+		py = y + dy * k
+		if px < 0 or py < 0 or px >= width or py >= height or blocked[px][py]:
+			return False
+		if runs[px][py][1] - runs[px][py][0] + 1 > length:
+			return True
+	return False
+
+def suggest_gates(tiles, env, max_length=default_gate_max_length):
+	"""Find straight gateways across narrow passages between cliffs of a compiled tile plane"""
+	blocked = get_blocked_tiles(tiles, env)
+	dist = distance_transform(blocked)
+	width = len(blocked)
+	height = len(blocked[0])
+	probe = max_length * 2
+	# Ignore gaps next to small isolated cliffs that can be walked around
+	region_sizes = get_blocked_regions_size(blocked)
+	candidates = []
+	for horizontal in [True, False]:
+		runs = get_runs(blocked, horizontal)
+		for y in range(height):
+			for x in range(width):
+				if blocked[x][y]:
+					continue
+				start, end = runs[x][y]
+				length = end - start + 1
+				# One candidate per line, from its middle tile
+				if length > max_length or (x if horizontal else y) != (start + end) // 2:
+					continue
+				dx, dy = (0, 1) if horizontal else (1, 0)
+				if horizontal:
+					ends = [(start - 1, y), (end + 1, y)]
+				else:
+					ends = [(x, start - 1), (x, end + 1)]
+				if min([region_sizes[ex][ey] for (ex, ey) in ends]) < max_length:
+					continue
+				if not is_passage_side(runs, blocked, x, y, -dx, -dy, length, probe) \
+				or not is_passage_side(runs, blocked, x, y, dx, dy, length, probe):
+					continue
+				if horizontal:
+					gate = {"startx": start, "starty": y, "endx": end, "endy": y}
+				else:
+					gate = {"startx": x, "starty": start, "endx": x, "endy": end}
+				# Narrowest passages first: closest to cliffs, then shortest
+				candidates.append((dist[x][y], length, y, x, gate))
+			#end-for
+		#end-for
+	#end-for
+	candidates.sort(key=lambda c: c[0:4])
+	# Keep one gate per passage, skipping candidates close to an accepted gate
+	claimed = []
+	for x in range(width):
+		claimed.append([False] * height)
+	gates = []
+	for c in candidates:
+		gate = c[4]
+		if any(claimed[gx][gy] for gx in range(gate["startx"], gate["endx"]+1) for gy in range(gate["starty"], gate["endy"]+1)):
+			continue
+		gates.append(gate)
+		for gx in range(max(0, gate["startx"] - max_length), min(width, gate["endx"] + max_length + 1)):
+			for gy in range(max(0, gate["starty"] - max_length), min(height, gate["endy"] + max_length + 1)):
+				claimed[gx][gy] = True
+	#end-for
+	return gates
+
+def write_gatemap(filename, gates, size):
+	"""Write gates as a gatemap png of the given size"""
+	img = Image.new('RGBA', size)
+	for gate in gates:
+		for x in range(gate["startx"], gate["endx"]+1):
+			for y in range(gate["starty"], gate["endy"]+1):
+				img.putpixel((x,y), gate_color)
+	img.save(filename)
+
 
 def write_header(output, width, height):
 	"""Write the first bytes of the .map file in output"""
@@ -437,31 +645,18 @@ def write_lev(output, name, players, env):
 	output.write(("game    \"multiplay/maps/%s.gam\"\n"%name))
 	return
 
-def autogen_cliffmap(heightfilename, step, outfilename):
-	try:
-		img = Image.open(heightfilename)
-	except FileNotFoundError:
-		print("File %s not found"%heightfilename)
-		return
-	except Error:
-		print("Error reading %s"%heightfilename)
-		return
-	mode = img.mode
-	width,height = img.size
-	cliff = Image.new('RGBA', img.size)
-	print("Reading heightmap %s as %s" % (heightfilename, mode))
-	if mode != "RGB" and mode != "RGBA" and mode != "L":
-		print("Cannot parse heightmap, accepting only RGB, RGBA or L (greyscale)")
-		return
+def is_autocliff(tile_heights, step):
+	"""Tell if a tile is a cliff from the height of its 4 vertices"""
+	return max(tile_heights) - min(tile_heights) >= step
+
+def autogen_cliffmap(heights, step, outfilename):
+	"""Write a cliffmap in outfilename marking tiles with a height difference of at least step"""
+	width = len(heights)
+	height = len(heights[0])
+	cliff = Image.new('RGBA', (width, height))
 	for y in range(height-2):
 		for x in range(width-2):
-			px = img.getpixel((x, y))[0]
-			pxx = img.getpixel((x+1, y))[0]
-			pxy = img.getpixel((x, y+1))[0]
-			pxxy = img.getpixel((x+1, y+1))[0]
-			top = max(px, pxx, pxy, pxxy)
-			bottom = min(px, pxx, pxy, pxxy)
-			if (top - bottom >= step):
+			if is_autocliff(get_tile_height(heights, x, y), step):
 				cliff.putpixel((x,y), (255,64,64,255))
 			else:
 				cliff.putpixel((x,y), (0,0,0,0))
@@ -471,6 +666,350 @@ def autogen_cliffmap(heightfilename, step, outfilename):
 	return True
 
 
+# Generated terrain layers by height: (max height, flat tile, steep tile)
+# Steep tiles have a cliff texture so that autocliffed tiles are always valid
+rockies_gen_layers = [
+	(24, 17, 5), # water, gravel shores
+	(100, 0, 5), # grass, gravel
+	(150, 53, 5), # dirt, gravel
+	(190, 23, 41), # grass snow, gravel snow
+	(225, 41, 41), # gravel snow
+	(255, 64, 64), # snow
+]
+arizona_gen_layers = [
+	(24, 17, 48), # water, red
+	(80, 23, 48), # green, red
+	(130, 12, 48), # sand, red
+	(180, 9, 48), # yellow, red
+	(220, 5, 48), # brown, red
+	(255, 48, 48), # red
+]
+urban_gen_layers = [
+	(24, 17, 78), # water, gray
+	(90, 50, 78), # green, gray
+	(150, 22, 78), # orange, gray
+	(210, 78, 78), # gray
+	(255, 51, 51), # concrete
+]
+env_gen_layers = {
+	"r": rockies_gen_layers,
+	"u": urban_gen_layers,
+	"a": arizona_gen_layers,
+}
+default_gen_cells = 4 # noise cells along the map for the first octave
+default_gen_octaves = 4
+
+# Vertex transformations for each symetry, the group they generate is applied to the heights
+def sym_ns(x, y, w, h): return (x, h - y)
+def sym_ew(x, y, w, h): return (w - x, y)
+def sym_180(x, y, w, h): return (w - x, h - y)
+def sym_nwse(x, y, w, h): return (h - y, w - x)
+def sym_swne(x, y, w, h): return (y, x)
+def sym_90(x, y, w, h): return (h - y, x)
+symetry_transforms = {
+	"N-S": [sym_ns],
+	"E-W": [sym_ew],
+	"180": [sym_180],
+	"NW-SE": [sym_nwse],
+	"SW-NE": [sym_swne],
+	"cross-straight-NvS": [sym_ns, sym_ew],
+	"cross-straight-EvW": [sym_ns, sym_ew],
+	"cross-straight-90": [sym_90],
+	"cross-diag-NWvSE": [sym_nwse, sym_swne],
+	"cross-diag-NEvSW": [sym_nwse, sym_swne],
+	"cross-diag-90": [sym_90],
+}
+square_symetries = ["NW-SE", "SW-NE", "cross-straight-90", "cross-diag-NWvSE", "cross-diag-NEvSW", "cross-diag-90"]
+
+def smooth_lattice_coords(size, period, cells):
+	"""Get the lattice cells and smoothed interpolation factor of each coordinate, wrapping every period"""
+	coords = []
+	for i in range(size):
+		f = (i % period) * cells / period
+		c = int(f)
+		t = f - c
+		coords.append((c, (c + 1) % cells, t * t * (3 - 2 * t)))
+	return coords
+
+def generate_noise(width, height, rnd, cells=default_gen_cells, octaves=default_gen_octaves):
+	"""Get a 2-dimensional array of width+1 x height+1 vertices of tileable value noise"""
+	noise = []
+	for x in range(width + 1):
+		noise.append([0.0] * (height + 1))
+	amplitude = 1.0
+	for o in range(octaves):
+		xcells = cells * 2**o
+		ycells = max(1, round(xcells * height / width))
+		lattice = [[rnd.random() * amplitude for j in range(ycells)] for i in range(xcells)]
+		ycoords = smooth_lattice_coords(height + 1, height, ycells)
+		for x, (x0, x1, tx) in enumerate(smooth_lattice_coords(width + 1, width, xcells)):
+			column = noise[x]
+			l0 = lattice[x0]
+			l1 = lattice[x1]
+			for y, (y0, y1, ty) in enumerate(ycoords):
+				a = l0[y0] + (l1[y0] - l0[y0]) * tx
+				b = l0[y1] + (l1[y1] - l0[y1]) * tx
+				column[y] += a + (b - a) * ty
+			#end-for
+		#end-for
+		amplitude = amplitude / 2
+	#end-for
+	return noise
+
+def apply_symetry(m, transforms):
+	"""Copy each vertex of m from the smallest vertex of its orbit under transforms"""
+	w = len(m) - 1
+	h = len(m[0]) - 1
+	for x in range(w + 1):
+		for y in range(h + 1):
+			orbit = {(x, y)}
+			todo = [(x, y)]
+			while todo:
+				p = todo.pop()
+				for t in transforms:
+					q = t(p[0], p[1], w, h)
+					if not q in orbit:
+						orbit.add(q)
+						todo.append(q)
+			src = min(orbit)
+			m[x][y] = m[src[0]][src[1]]
+		#end-for
+	#end-for
+
+def generate_heights(width, height, seed, symetry=None):
+	"""Get a 2-dimensional array of heights for a map of width x height tiles from seed"""
+	if symetry and not symetry in symetry_transforms:
+		print("Unknown symetry %s, must be one of %s"%(symetry, list(symetry_transforms)))
+		return
+	if symetry in square_symetries and width != height:
+		print("Symetry %s requires a square map"%symetry)
+		return
+	rnd = random.Random(seed)
+	noise = generate_noise(width, height, rnd)
+	low = min([min(column) for column in noise])
+	high = max([max(column) for column in noise])
+	scale = 255 / (high - low) if high > low else 0
+	heights = []
+	for column in noise:
+		heights.append([int((v - low) * scale) for v in column])
+	if symetry:
+		apply_symetry(heights, symetry_transforms[symetry])
+	return heights
+
+def generate_tile(tile_heights, layers, step):
+	"""Get the base tile index from the height and slope of a tile, steep tiles are the autocliffed ones"""
+	average = sum(tile_heights) / 4
+	steep = is_autocliff(tile_heights, step)
+	for (top, flat, steep_tile) in layers:
+		if average <= top:
+			break
+	return steep_tile if steep else flat
+
+def generate_planes(props, seed, step):
+	"""Generate heights, tiles and rotation planes from seed without any png file"""
+	heights = generate_heights(props['width'], props['height'], seed, props.get('symetry'))
+	if not heights:
+		return
+	if props.get('filters'):
+		if locks_cliffs(props):
+			print("Cliffs are not locked on generated maps, ignoring lockcliffs")
+		heights = apply_filters(heights, props['filters'])
+	width = len(heights)
+	height = len(heights[0])
+	layers = env_gen_layers[props['env'][0]]
+	basetiles = []
+	cliffs = []
+	for x in range(width):
+		basetiles.append([0] * height)
+		cliffs.append([False] * height)
+	for y in range(height-1):
+		for x in range(width-1):
+			tile_heights = get_tile_height(heights, x, y)
+			basetiles[x][y] = generate_tile(tile_heights, layers, step)
+			cliffs[x][y] = is_autocliff(tile_heights, step)
+		#end-for
+	#end-for
+	errors = {"tiles": [], "cliffs": []}
+	tiles = classify_tiles(lambda x, y: basetiles[x][y], lambda x, y: cliffs[x][y],
+		width, height, props['env'], heights, errors["tiles"], errors["cliffs"])
+	print_tile_errors(errors["tiles"], "Error(s) while generating tiles: unknown tile(s)")
+	print_tile_errors(errors["cliffs"], "Error(s) while generating cliffs: incompatible base tile(s)")
+	rotmap = cliffs_to_rotbytes(lambda x, y: cliffs[x][y], width, height, props['env'], heights, tiles)
+	return {
+		"heights": heights,
+		"tiles": tiles,
+		"rotmap": rotmap,
+		"errors": errors,
+		"gates": suggest_gates(tiles, props['env'], props.get('gatelength', default_gate_max_length)),
+	}
+
+# ImageMath.eval was renamed in Pillow 10.3, only constant expressions are evaluated here
+image_eval = getattr(ImageMath, "unsafe_eval", None) or ImageMath.eval
+
+def round_image(m):
+	"""Round a F image to a L image, clamping to 0-255"""
+	# Converting to L truncates
+	return image_eval("m + 0.5", m=m).convert('L')
+
+def shift_image(img, dx, dy, fill):
+	"""Get img moved so that each pixel holds the value of its (dx, dy) neighbour, fill outside"""
+	width, height = img.size
+	shifted = Image.new(img.mode, img.size, fill)
+	shifted.paste(img.crop((max(0, dx), max(0, dy), width + min(0, dx), height + min(0, dy))), (max(0, -dx), max(0, -dy)))
+	return shifted
+
+def filter_smooth(img, sigma):
+	return img.filter(ImageFilter.GaussianBlur(sigma))
+
+def filter_terrace(img, steps):
+	step = 255 / (steps - 1)
+	return img.point([int(round(round(v / step) * step)) for v in range(256)])
+
+def filter_border(img, width, height):
+	"""Bring vertices closer than width to the border to height, linearly"""
+	if width == 0:
+		return img
+	w, h = img.size
+	# Weight of the vertex height, from 0 on the border to 1 from width inwards
+	columns = Image.new('F', (w, 1))
+	columns.putdata([min(1, min(x, w - 1 - x) / width) for x in range(w)])
+	rows = Image.new('F', (1, h))
+	rows.putdata([min(1, min(y, h - 1 - y) / width) for y in range(h)])
+	weight = image_eval("min(a, b)", a=columns.resize(img.size, Image.NEAREST), b=rows.resize(img.size, Image.NEAREST))
+	return round_image(image_eval("height + (m - height) * weight", m=img.convert('F'), weight=weight, height=height))
+
+def filter_erosion(img, iterations, talus, rate):
+	"""Thermal erosion: move material to the lowest neighbour of each vertex where the slope is above talus"""
+	m = img.convert('F')
+	# In the order ties are broken, outside of the map is never the lowest
+	directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+	for i in range(iterations):
+		neighbours = [shift_image(m, dx, dy, 1e9) for (dx, dy) in directions]
+		lowest = image_eval("min(min(a, b), min(c, d))", a=neighbours[0], b=neighbours[1], c=neighbours[2], d=neighbours[3])
+		moved = image_eval("max(m - lowest - talus, 0) * rate / 2", m=m, lowest=lowest, talus=talus, rate=rate)
+		m = image_eval("m - moved", m=m, moved=moved)
+		taken = Image.new('F', m.size, 0)
+		for (dx, dy), n in zip(directions, neighbours):
+			given = image_eval("(n == lowest) * (1 - taken)", n=n, lowest=lowest, taken=taken)
+			taken = image_eval("taken + given", taken=taken, given=given)
+			received = shift_image(image_eval("moved * given", moved=moved, given=given), -dx, -dy, 0)
+			m = image_eval("m + received", m=m, received=received)
+		#end-for
+	#end-for
+	return round_image(m)
+
+height_filters = {
+	# filter type: (function, default parameters)
+	"smooth": (filter_smooth, {"sigma": 1.0}),
+	"terrace": (filter_terrace, {"steps": 8}),
+	"border": (filter_border, {"width": 3, "height": 0}),
+	"erosion": (filter_erosion, {"iterations": 5, "talus": 8, "rate": 0.5}),
+}
+
+# Filter parameters limits: (whole number, minimum, maximum, minimum excluded)
+filter_param_limits = {
+	"sigma": (False, 0, None, True),
+	"steps": (True, 2, None, False),
+	"width": (False, 0, None, False),
+	"height": (False, None, None, False),
+	"iterations": (True, 0, None, False),
+	"talus": (False, None, None, False),
+	"rate": (False, 0, 1, False),
+}
+
+def check_filter_param(name, key, value):
+	"""Check a filter parameter value, return an error or None"""
+	whole, low, high, exclusive = filter_param_limits[key]
+	if isinstance(value, bool) or not isinstance(value, int if whole else (int, float)):
+		return "Parameter %s of filter %s must be a %s, not %s"%(key, name, "whole number" if whole else "number", value)
+	if low != None and (value < low or (exclusive and value == low)):
+		return "Parameter %s of filter %s must be %s %s, not %s"%(key, name, "above" if exclusive else "at least", low, value)
+	if high != None and value > high:
+		return "Parameter %s of filter %s must be at most %s, not %s"%(key, name, high, value)
+
+def check_filters(filters):
+	"""Check the filters from map.json, return a list of errors"""
+	if not isinstance(filters, list):
+		return ["filters in map.json must be a list"]
+	errors = []
+	for f in filters:
+		if not isinstance(f, dict) or not f.get('type') in height_filters:
+			errors.append("Unknown filter %s, type must be one of %s"%(f, list(height_filters)))
+			continue
+		for key, value in f.items():
+			if key == 'type':
+				continue
+			if key == 'lockcliffs':
+				if not isinstance(value, bool):
+					errors.append("lockcliffs of filter %s must be true or false, not %s"%(f['type'], value))
+			elif not key in height_filters[f['type']][1]:
+				errors.append("Unknown parameter %s for filter %s, must be one of %s"%(key, f['type'], list(height_filters[f['type']][1])))
+			else:
+				error = check_filter_param(f['type'], key, value)
+				if error:
+					errors.append(error)
+	return errors
+
+def apply_filters(heights, filters, locked=None):
+	"""Apply the filters from map.json to heights, in order. Vertices set in locked are not modified
+	by filters with lockcliffs. Return a new 2-dimensional array of heights"""
+	img = plane_to_image(heights)
+	mask = None
+	if locked:
+		mask = plane_to_image([[255 if v else 0 for v in column] for column in locked])
+	for f in filters:
+		function, params = height_filters[f['type']]
+		args = dict(params)
+		for key in params:
+			if key in f:
+				args[key] = f[key]
+		filtered = function(img, **args)
+		if f.get('lockcliffs') and mask:
+			filtered = Image.composite(img, filtered, mask)
+		img = filtered
+	#end-for
+	return image_to_plane(img)
+
+def get_cliff_vertices(cliffs, width, height):
+	"""Get a 2-dimensional array telling which vertices are a corner of a cliff tile in the cliffs array"""
+	locked = []
+	for x in range(width):
+		locked.append([False] * height)
+	for y in range(min(height, len(cliffs[0])) - 1):
+		for x in range(min(width, len(cliffs)) - 1):
+			if cliffs[x][y]:
+				locked[x][y] = locked[x+1][y] = locked[x][y+1] = locked[x+1][y+1] = True
+		#end-for
+	#end-for
+	return locked
+
+def filter_heights(heights, props, cliffs=None, log=None):
+	"""Apply the filters from props to heights, locking the vertices of the cliffs array when set"""
+	if not props.get('filters'):
+		return heights
+	locked = None
+	if cliffs:
+		locked = get_cliff_vertices(cliffs, len(heights), len(heights[0]))
+	log_message("Applying %d height filter(s)"%len(props['filters']), log)
+	return apply_filters(heights, props['filters'], locked)
+
+def locks_cliffs(props):
+	return any([f.get('lockcliffs') for f in props.get('filters', [])])
+
+def read_filtered_heights(mapdir, props):
+	"""Read the heightmap of mapdir and apply the filters from props"""
+	heights = read_heightmap(os.path.join(mapdir, "heightmap.png"))
+	if not heights:
+		return
+	cliffs = None
+	if locks_cliffs(props):
+		cimg = read_image(os.path.join(mapdir, "cliffmap.png"), "cliffmap")
+		if cimg:
+			cliffs = image_to_booleans(cimg)
+		else:
+			print("Cliffs are not locked")
+	return filter_heights(heights, props, cliffs)
+
 def get_base_dir(mapdir):
 	if mapdir[0] == "/":
 		return mapdir
@@ -484,101 +1023,374 @@ def read_map_props(filepath):
 	#open end
 	return props
 
-if len(sys.argv) < 2:
-	print("Usage:")
-	print("	wzmapcompiler.py mapdir")
-	print("	wzmapcompiler.py autocliff [min step=%d] mapdir"%default_autocliff_diff)
-	exit()
-
-mapdir = sys.argv[1]
-if (len(sys.argv) >= 2 and sys.argv[1] == "autocliff"):
-	step = default_autocliff_diff
-	mapdir = sys.argv[2]
-	if (len(sys.argv) >= 4):
-		step = int(sys.argv[2])
-		mapdir = sys.argv[3]
+def load_map_props(mapdir):
+	"""Read and check map.json from mapdir, return None when it is not usable"""
+	try:
+		props = read_map_props(os.path.join(mapdir, "map.json"))
+	except FileNotFoundError:
+		print("Cannot read %s"%os.path.join(mapdir, "map.json"))
+		return
+	except json.decoder.JSONDecodeError as e:
+		print("Cannot parse %s: %s"%(os.path.join(mapdir, "map.json"), e))
+		return
+	errors = check_map_props(props)
+	for error in errors:
+		print(error)
+	if errors:
+		return
+	if not ('name' in props):
+		props['name'] = os.path.basename(os.path.abspath(os.path.join(os.getcwd(), mapdir)))
+	return props
+
+def check_map_props(props):
+	"""Check the properties read from map.json, return a list of errors"""
+	if not isinstance(props, dict) or not ('width' in props) or not ('height' in props) or not ('players' in props) or not ('env' in props):
+		return ["Cannot read width, height, env and/or players from map.json"]
+	errors = []
+	for key in ['width', 'height', 'players']:
+		if not isinstance(props[key], int) or props[key] <= 0:
+			errors.append("%s in map.json must be a positive number, not %s"%(key, props[key]))
+	if 'autocliff' in props and not isinstance(props['autocliff'], (int, float)):
+		errors.append("autocliff in map.json must be a number, not %s"%props['autocliff'])
+	if 'gatelength' in props and not isinstance(props['gatelength'], int):
+		errors.append("gatelength in map.json must be a whole number, not %s"%props['gatelength'])
+	if not isinstance(props['env'], str) or not props['env'][0:1] in env_dataset:
+		errors.append("Environment not found, should be 'arizona', 'urban' or 'rockies'")
+	if 'symetry' in props and not props['symetry'] in symetry_transforms:
+		errors.append("Unknown symetry %s, must be one of %s"%(props['symetry'], list(symetry_transforms)))
+	if 'filters' in props:
+		errors.extend(check_filters(props['filters']))
+	return errors
+
+def check_image(filename, size, required=True, per_tile=False):
+	"""Check the mode and size of a png from its header without decoding it, return a list of errors
+	Per tile maps may also be exactly the map size, without the extra vertice line"""
+	try:
+		with Image.open(filename) as img:
+			mode = img.mode
+			img_size = img.size
+	except FileNotFoundError:
+		if required:
+			return ["File %s not found"%filename]
+		return []
+	except OSError as e:
+		return ["Error reading %s: %s"%(filename, e)]
+	errors = []
+	if mode != "RGB" and mode != "RGBA" and mode != "L":
+		errors.append("Cannot parse %s as %s, accepting only RGB, RGBA or L (greyscale)"%(filename, mode))
+	if per_tile and img_size == (size[0]-1, size[1]-1):
+		return errors
+	if img_size != size:
+		expected = "%dx%d"%size
+		if per_tile:
+			expected = "%s or %dx%d"%(expected, size[0]-1, size[1]-1)
+		errors.append("%s is %dx%d pixels, expecting %s for a map of %dx%d tiles"%(filename, img_size[0], img_size[1], expected, size[0]-1, size[1]-1))
+	return errors
+
+def check_json(filename):
+	"""Check that a json file can be parsed, return a list of errors"""
+	try:
+		with open(filename, 'r') as json_file:
+			json.load(json_file)
+	except FileNotFoundError:
+		return ["File %s not found"%filename]
+	except (json.decoder.JSONDecodeError, UnicodeDecodeError) as e:
+		return ["Cannot parse %s: %s"%(filename, e)]
+	return []
+
+def check_file(filename):
+	if not os.path.isfile(filename):
+		return ["File %s not found"%filename]
+	return []
+
+def preflight(mapdir, images=True):
+	"""Check map.json, png headers and object files of mapdir concurrently, return a list of errors"""
+	try:
+		props = read_map_props(os.path.join(mapdir, "map.json"))
+	except FileNotFoundError:
+		return ["Cannot read %s"%os.path.join(mapdir, "map.json")]
+	except json.decoder.JSONDecodeError as e:
+		return ["Cannot parse %s: %s"%(os.path.join(mapdir, "map.json"), e)]
+	errors = check_map_props(props)
+	if errors:
+		return errors
+	checks = [
+		(check_json, os.path.join(mapdir, "droid.json")),
+		(check_json, os.path.join(mapdir, "feature.json")),
+		(check_json, os.path.join(mapdir, "struct.json")),
+		(check_file, os.path.join(mapdir, "ttypes.ttp")),
+	]
+	if images:
+		size = (props['width'] + 1, props['height'] + 1)
+		checks.extend([
+			(check_image, os.path.join(mapdir, "heightmap.png"), size),
+			(check_image, os.path.join(mapdir, "tilemap.png"), size),
+			(check_image, os.path.join(mapdir, "cliffmap.png"), size),
+			(check_image, os.path.join(mapdir, "gatemap.png"), size, False, True),
+		])
+	with concurrent.futures.ThreadPoolExecutor(len(checks)) as pool:
+		futures = [pool.submit(*check) for check in checks]
+		for future in futures:
+			errors.extend(future.result())
+	return errors
+
+def read_autocliff_props(mapdir):
+	"""Get map.json from mapdir for autocliff step and filters, or empty properties"""
+	try:
+		return read_map_props(os.path.join(mapdir, "map.json"))
+	except FileNotFoundError:
+		print("Cannot read %s, using default step"%os.path.join(mapdir, "map.json"))
+	return {}
+
+def plane_stages(mapdir, props, errors=None):
+	"""Get the stages decoding heightmap, tilemap and cliffmap from mapdir into the planes written in game.map
+	Each png is decoded by its own stage, only the tiles and rotations wait for the heights"""
+	env = props['env']
+	def read_tiles(r):
+		return image_to_tiles(r["tilemap"], r["cliffs"], env, r["heights"], os.path.join(mapdir, "errormap.png"), errors, r["log"])
+	return {
+		"heightmap": (lambda r: read_image(os.path.join(mapdir, "heightmap.png"), "heightmap", r["log"]), []),
+		"tilemap": (lambda r: read_image(os.path.join(mapdir, "tilemap.png"), "tilemap", r["log"]), []),
+		"cliffmap": (lambda r: read_image(os.path.join(mapdir, "cliffmap.png"), "cliffmap", r["log"]), []),
+		"cliffs": (lambda r: image_to_booleans(r["cliffmap"]), ["cliffmap"]),
+		"heights": (lambda r: filter_heights(image_to_plane(r["heightmap"]), props, r.get("cliffs"), r["log"]),
+			["heightmap", "cliffs"] if locks_cliffs(props) else ["heightmap"]),
+		"tiles": (read_tiles, ["heights", "tilemap", "cliffs"]),
+		"rotmap": (lambda r: cliffs_to_rotbytes(lambda x, y: r["cliffs"][x][y], len(r["cliffs"]), len(r["cliffs"][0]), env, r["heights"], r["tiles"]),
+			["heights", "tiles", "cliffs"]),
+	}
+
+def read_planes(mapdir, props):
+	"""Decode heightmap, tilemap and cliffmap from mapdir into the planes written in game.map"""
+	errors = {}
+	results = run_stages(plane_stages(mapdir, props, errors))
+	if not results:
+		return
+	return {
+		"heights": results["heights"],
+		"tiles": results["tiles"],
+		"rotmap": results["rotmap"],
+		"errors": errors,
+	}
+
+def write_preview(filename, env, heights, tiles):
+	"""Write a flat top view of the map, one pixel per tile, shaded by height"""
+	colors = {}
+	for rgb, tile in env_tiledef[env[0]].items():
+		colors[tile] = rgb
+	width = len(tiles) - 1
+	height = len(tiles[0]) - 1
+	img = Image.new('RGB', (width, height))
+	for y in range(height):
+		for x in range(width):
+			# Tiles without a tilemap color are cliffs
+			rgb = colors.get(tiles[x][y], preview_cliff_color)
+			shade = 0.5 + sum(get_tile_height(heights, x, y)) / 2040
+			img.putpixel((x,y), (int(rgb[0]*shade), int(rgb[1]*shade), int(rgb[2]*shade)))
+		#end-for
+	#end-for
+	img.save(filename)
+
+def run_stages(stages, results=None, workers=None):
+	"""Run stages {name: (function, dependencies)} on a thread pool, each one as soon as its dependencies are done.
+	Functions get a dict of the results of the stages done so far, returning None means the stage failed
+	and stops starting new stages. Stages append their messages to the "log" list of that dict,
+	they are printed at once when the stage is done. Return the results of all stages, or None when one failed"""
+	results = dict(results or {})
+	pending = dict(stages)
+	running = {}
+	failed = False
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		while pending or running:
+			if not failed:
+				for name, (function, dependencies) in list(pending.items()):
+					if all(d in results for d in dependencies):
+						stage_results = dict(results)
+						stage_results["log"] = []
+						running[pool.submit(function, stage_results)] = (name, stage_results["log"])
+						del pending[name]
+			if not running:
+				break
+			done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+			for future in done:
+				name, log = running.pop(future)
+				for message in log:
+					print(message)
+				result = future.result()
+				if result is None:
+					failed = True
+				else:
+					results[name] = result
+		#end-while
+	#end-with
+	if failed:
+		return
+	return results
+
+def compile_map(mapdir, props, planes):
+	"""Write game.map and the other map files, return the .wz file path
+	When a plane is missing from the planes dict, they are decoded from the png files and stored in it.
+	Stages are run concurrently, following their dependencies"""
+	name = props['name']
+	env = props['env']
+	os.makedirs(os.path.join(mapdir, "build", "multiplay", "maps", name), exist_ok=True)
+	stages = {}
+	errors = {}
+
+	def suggest_map_gates(r):
+		gates = suggest_gates(r["tiles"], env, props.get('gatelength', default_gate_max_length))
+		r["log"].append("No gatemap.png, using %d suggested gateways"%len(gates))
+		return gates
+	decode = not all([plane in planes for plane in ["heights", "tiles", "rotmap"]])
+	if decode:
+		stages.update(plane_stages(mapdir, props, errors))
+	if "gates" in planes:
+		pass
+	elif os.path.exists(os.path.join(mapdir, "gatemap.png")):
+		stages["gatemap"] = (lambda r: read_image(os.path.join(mapdir, "gatemap.png"), "gatemap", r["log"]), [])
+		stages["gates"] = (lambda r: image_to_gates(r["gatemap"]), ["gatemap"])
 	else:
-		try:
-			props = read_map_props(os.path.join(mapdir, "map.json"))
-			if 'autocliff' in props:
-				step = props['autocliff']
-		except FileNotFoundError:
-			print("Cannot read %s, using default step"%os.path.join(mapdir, "map.json"))
-	mapdir = get_base_dir(mapdir)
-	if autogen_cliffmap(os.path.join(mapdir, "heightmap.png"), step, os.path.join(mapdir, "autocliffmap.png")):
-		print("Done generating cliffmap into autocliffmap.png with step of %d."%step)
-	exit()
-
-if mapdir == '.':
-	mapdir = os.getcwd()
-
-try:
-	props = read_map_props(os.path.join(mapdir, "map.json"))
-except FileNotFoundError:
-	print("Cannot read %s"%os.path.join(mapdir, "map.json"))
-	exit()
-except json.decoder.JSONDecodeError as e:
-	print("Cannot parse %s: %s"%(os.path.join(mapdir, "map.json"), e))
-	exit()
-
-if not ('width' in props) or not ('height' in props) or not ('players' in props) or not ('env' in props):
-	print("Cannot read width, height, env and/or players from map.json")
-	exit()
-
-if not props['env'][0] in env_dataset:
-	print("Environment not found, should be 'arizona', 'urban' or 'rockies'")
-	exit()
-
-if not ('name' in props):
-	props['name'] = os.path.basename(os.path.abspath(os.path.join(os.getcwd(), mapdir)))
-
-
-os.makedirs(os.path.join(mapdir, "build", "multiplay", "maps", props['name']), exist_ok=True)
-
-with open(os.path.join(mapdir, "build/multiplay/maps/%s/game.map"%props['name']), 'wb') as o:
-	heights = read_heightmap(os.path.join(mapdir, "heightmap.png"))
-	if not heights:
+		stages["gates"] = (suggest_map_gates, ["tiles"])
+
+	def write_game_map(r):
+		filename = "multiplay/maps/%s/game.map"%name
+		with open(os.path.join(mapdir, "build", filename), 'wb') as o:
+			write_header(o, props['width'], props['height'])
+			write_map(o, map_to_bytes(r["tiles"]), map_to_bytes(r["heights"]), r["rotmap"])
+			write_gateways(o, r["gates"])
+			r["log"].append("Done compiling game.map")
+		return filename
+	def write_gam_file(r):
+		filename = "multiplay/maps/%s.gam"%name
+		with open(os.path.join(mapdir, "build", filename), 'wb') as o:
+			write_gam(o, props['width'], props['height'])
+			r["log"].append("Done generating %s.gam"%name)
+		return filename
+	def write_lev_file(r):
+		filename = "%s.addon.lev"%name
+		with open(os.path.join(mapdir, "build", filename), 'w') as o:
+			write_lev(o, name, props['players'], env)
+			r["log"].append("Done creating %s.addon.lev"%name)
+		return filename
+	def copy_file(f, log):
+		filename = "multiplay/maps/%s/%s"%(name, f)
+		shutil.copyfile(os.path.join(mapdir, f), os.path.join(mapdir, "build", filename))
+		log.append("Copied %s into multiplayer"%f)
+		return filename
+	stages["game.map"] = (write_game_map, ["heights", "tiles", "rotmap", "gates"])
+	stages["gam"] = (write_gam_file, [])
+	stages["lev"] = (write_lev_file, [])
+	generated_stages = ["lev", "gam", "game.map"]
+	for f in ["ttypes.ttp", "droid.json", "feature.json", "struct.json"]:
+		stages[f] = (lambda r, f=f: copy_file(f, r["log"]), [])
+		generated_stages.append(f)
+
+	wzfilename = '%dc-%s.wz'%(props['players'], name)
+	def write_wz(r):
+		with zipfile.ZipFile(os.path.join(mapdir, wzfilename), 'w', zipfile.ZIP_DEFLATED) as wz:
+			for stage in generated_stages:
+				wz.write(os.path.join(mapdir, "build", r[stage]), r[stage])
+			r["log"].append("Done creating %s"%wzfilename)
+		return wzfilename
+	stages["wz"] = (write_wz, generated_stages)
+
+	results = run_stages(stages, planes)
+	if not results:
+		return
+	# Gates are read again on each compile, gatemap.png is not a plane source
+	if decode:
+		for plane in ["heights", "tiles", "rotmap"]:
+			planes[plane] = results[plane]
+		planes["errors"] = errors
+	return os.path.join(mapdir, wzfilename)
+
+def main():
+	if len(sys.argv) < 2:
+		print("Usage:")
+		print("	wzmapcompiler.py mapdir")
+		print("	wzmapcompiler.py autocliff [min step=%d] mapdir"%default_autocliff_diff)
+		print("	wzmapcompiler.py check mapdir")
+		print("	wzmapcompiler.py autogate mapdir")
+		print("	wzmapcompiler.py generate [seed=0] [count=1] mapdir")
+		exit()
+
+	mapdir = sys.argv[1]
+	if (len(sys.argv) >= 2 and sys.argv[1] == "autocliff"):
+		mapdir = get_base_dir(sys.argv[-1])
+		props = read_autocliff_props(mapdir)
+		errors = check_filters(props.get('filters', []))
+		for error in errors:
+			print(error)
+		if errors:
+			exit(1)
+		step = props.get('autocliff', default_autocliff_diff)
+		if (len(sys.argv) >= 4):
+			step = int(sys.argv[2])
+		heights = read_filtered_heights(mapdir, props)
+		if not heights:
+			exit()
+		if autogen_cliffmap(heights, step, os.path.join(mapdir, "autocliffmap.png")):
+			print("Done generating cliffmap into autocliffmap.png with step of %d."%step)
 		exit()
-	heightmap = map_to_bytes(heights)
-	tiles = read_tilemap(os.path.join(mapdir, "tilemap.png"), os.path.join(mapdir, "cliffmap.png"), props['env'], heights)
-	tilemap = map_to_bytes(tiles)
-	if not tilemap:
+
+	if (sys.argv[1] == "check"):
+		errors = preflight(get_base_dir(sys.argv[2]))
+		for error in errors:
+			print(error)
+		if errors:
+			exit(1)
+		print("No error found in %s"%sys.argv[2])
 		exit()
-	rotmap = cliff_to_rotbytes(os.path.join(mapdir, "cliffmap.png"), props['env'], heights, tiles)
-	if not rotmap:
+
+	if (sys.argv[1] == "autogate"):
+		mapdir = get_base_dir(sys.argv[2])
+		props = load_map_props(mapdir)
+		if not props:
+			exit()
+		planes = read_planes(mapdir, props)
+		if not planes:
+			exit()
+		gates = suggest_gates(planes["tiles"], props['env'], props.get('gatelength', default_gate_max_length))
+		write_gatemap(os.path.join(mapdir, "autogatemap.png"), gates, (len(planes["tiles"]), len(planes["tiles"][0])))
+		print("Done generating %d gateways into autogatemap.png."%len(gates))
 		exit()
-	gates = gatemap_to_gates(os.path.join(mapdir, "gatemap.png"))
-	if gates == None:
+
+	if (sys.argv[1] == "generate"):
+		seed = 0
+		count = 1
+		mapdir = sys.argv[-1]
+		if (len(sys.argv) >= 4):
+			seed = int(sys.argv[2])
+		if (len(sys.argv) >= 5):
+			count = int(sys.argv[3])
+		mapdir = get_base_dir(mapdir)
+		errors = preflight(mapdir, False)
+		for error in errors:
+			print(error)
+		if errors:
+			exit(1)
+		props = load_map_props(mapdir)
+		step = props.get('autocliff', default_autocliff_diff)
+		name = props['name']
+		for s in range(seed, seed + count):
+			planes = generate_planes(props, s, step)
+			if not planes:
+				exit()
+			props['name'] = "%s-%d"%(name, s)
+			compile_map(mapdir, props, planes)
 		exit()
-	write_header(o, props['width'], props['height'])
-	write_map(o, tilemap, heightmap, rotmap)
-	write_gateways(o, gates)
-	print("Done compiling game.map")
-with open(os.path.join(mapdir, "build/multiplay/maps/%s.gam"%props['name']), 'wb') as o:
-	write_gam(o, props['width'], props['height'])
-	print("Done generating %s.gam"%props['name'])
-with open(os.path.join(mapdir, "build/%s.addon.lev"%props['name']), 'w') as o:
-	write_lev(o, props['name'], props['players'], props['env'])
-	print("Done creating %s.addon.lev"%props['name'])
-shutil.copyfile(os.path.join(mapdir, "droid.json"), os.path.join(mapdir, "build/multiplay/maps/%s/droid.json"%props['name']))
-shutil.copyfile(os.path.join(mapdir, "feature.json"), os.path.join(mapdir, "build/multiplay/maps/%s/feature.json"%props['name']))
-shutil.copyfile(os.path.join(mapdir, "struct.json"), os.path.join(mapdir, "build/multiplay/maps/%s/struct.json"%props['name']))
-shutil.copyfile(os.path.join(mapdir, "ttypes.ttp"), os.path.join(mapdir, "build/multiplay/maps/%s/ttypes.ttp"%props['name']))
-print("Copied ttypes.ttp, droid.json, feature.json and struct.json into multiplayer")
-
-generated_files=[
-	"%s.addon.lev"%props['name'],
-	"multiplay/maps/%s.gam"%props['name'],
-	"multiplay/maps/%s/game.map"%props['name'],
-	"multiplay/maps/%s/ttypes.ttp"%props['name'],
-	"multiplay/maps/%s/droid.json"%props['name'],
-	"multiplay/maps/%s/feature.json"%props['name'],
-	"multiplay/maps/%s/struct.json"%props['name'],
-]
 
-wzfilename = '%dc-%s.wz'%(props['players'], props['name'])
-with zipfile.ZipFile(os.path.join(mapdir, wzfilename), 'w', zipfile.ZIP_DEFLATED) as wz:
-	for f in generated_files:
-		wz.write(os.path.join(mapdir, "build", f), f)
-	print("Done creating %s"%wzfilename)
+	if mapdir == '.':
+		mapdir = os.getcwd()
+
+	errors = preflight(mapdir)
+	for error in errors:
+		print(error)
+	if errors:
+		exit(1)
+	props = load_map_props(mapdir)
+	if not compile_map(mapdir, props, {}):
+		exit(1)
 
+if __name__ == "__main__":
+	main()
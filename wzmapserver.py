@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import os, sys
+import time
+import zlib
+import wzmapcompiler
+
+# Files whose modification invalidates the decoded planes of a map
+plane_sources = ["map.json", "heightmap.png", "tilemap.png", "cliffmap.png"]
+default_cache_size = 8 # maps kept decoded per worker
+default_workers = os.cpu_count() or 1
+
+# Per worker process state, set by init_worker
+plane_cache = collections.OrderedDict()
+cache_size = default_cache_size
+
+def init_worker(size):
+	global cache_size
+	cache_size = size
+	# Compiler messages are captured per request, never written to the rpc stream
+	sys.stdout = sys.stderr
+
+def get_sources_mtime(mapdir):
+	mtimes = []
+	for f in plane_sources:
+		try:
+			mtimes.append(os.stat(os.path.join(mapdir, f)).st_mtime_ns)
+		except FileNotFoundError:
+			mtimes.append(None)
+	return tuple(mtimes)
+
+def get_planes(mapdir, timings):
+	"""Get props and planes of mapdir from the cache, decoding them when missing or outdated"""
+	mtimes = get_sources_mtime(mapdir)
+	if mapdir in plane_cache and plane_cache[mapdir]["mtimes"] == mtimes:
+		plane_cache.move_to_end(mapdir)
+		return plane_cache[mapdir]
+	start = time.perf_counter()
+	props = wzmapcompiler.load_map_props(mapdir)
+	if not props:
+		return
+	planes = wzmapcompiler.read_planes(mapdir, props)
+	timings["decode"] = time.perf_counter() - start
+	if not planes:
+		return
+	entry = {"mtimes": mtimes, "props": props, "planes": planes}
+	plane_cache[mapdir] = entry
+	plane_cache.move_to_end(mapdir)
+	while len(plane_cache) > cache_size:
+		plane_cache.popitem(last=False)
+	return entry
+
+def do_compile(mapdir, params, timings):
+	start = time.perf_counter()
+	errors = wzmapcompiler.preflight(mapdir)
+	timings["preflight"] = time.perf_counter() - start
+	for error in errors:
+		print(error)
+	if errors:
+		return
+	entry = get_planes(mapdir, timings)
+	if not entry:
+		return
+	start = time.perf_counter()
+	wzfile = wzmapcompiler.compile_map(mapdir, entry["props"], entry["planes"])
+	timings["write"] = time.perf_counter() - start
+	if not wzfile:
+		return
+	return {"files": [wzfile]}
+
+def do_autocliff(mapdir, params, timings):
+	props = wzmapcompiler.read_autocliff_props(mapdir)
+	errors = wzmapcompiler.check_filters(props.get('filters', []))
+	for error in errors:
+		print(error)
+	if errors:
+		return
+	step = params.get("step")
+	if step == None:
+		step = props.get('autocliff', wzmapcompiler.default_autocliff_diff)
+	heights = wzmapcompiler.read_filtered_heights(mapdir, props)
+	if not heights:
+		return
+	outfilename = os.path.join(mapdir, "autocliffmap.png")
+	if not wzmapcompiler.autogen_cliffmap(heights, step, outfilename):
+		return
+	return {"files": [outfilename], "step": step}
+
+def do_verify(mapdir, params, timings):
+	entry = get_planes(mapdir, timings)
+	if not entry:
+		return
+	errors = entry["planes"]["errors"]
+	result = {
+		"unknown_tiles": len(errors["tiles"]),
+		"incompatible_cliffs": len(errors["cliffs"]),
+		"errors": {
+			"tiles": errors["tiles"][:wzmapcompiler.default_error_list_count],
+			"cliffs": errors["cliffs"][:wzmapcompiler.default_error_list_count],
+		},
+		"files": [],
+	}
+	if errors["tiles"] or errors["cliffs"]:
+		result["files"].append(os.path.join(mapdir, "errormap.png"))
+	return result
+
+def do_preview(mapdir, params, timings):
+	entry = get_planes(mapdir, timings)
+	if not entry:
+		return
+	start = time.perf_counter()
+	outfilename = os.path.join(mapdir, "preview.png")
+	wzmapcompiler.write_preview(outfilename, entry["props"]["env"], entry["planes"]["heights"], entry["planes"]["tiles"])
+	timings["write"] = time.perf_counter() - start
+	return {"files": [outfilename]}
+
+methods = {
+	"compile": do_compile,
+	"autocliff": do_autocliff,
+	"verify": do_verify,
+	"preview": do_preview,
+}
+
+def run_request(method, mapdir, params):
+	"""Run a request in a worker process, return (result, log, timings)"""
+	timings = {}
+	log = io.StringIO()
+	with contextlib.redirect_stdout(log):
+		result = methods[method](mapdir, params, timings)
+	return (result, log.getvalue(), timings)
+
+
+class CompileServer:
+	def __init__(self, workers=default_workers, cache=default_cache_size):
+		# One process per worker so a map always lands on the same decoded cache,
+		# requests on the same map are queued and other maps run concurrently
+		self.workers = []
+		for i in range(workers):
+			self.workers.append(concurrent.futures.ProcessPoolExecutor(1, initializer=init_worker, initargs=(cache,)))
+
+	def get_worker(self, mapdir):
+		return self.workers[zlib.crc32(mapdir.encode()) % len(self.workers)]
+
+	def shutdown(self):
+		for worker in self.workers:
+			worker.shutdown()
+
+	def send(self, output, response):
+		response["jsonrpc"] = "2.0"
+		output(json.dumps(response) + "\n")
+
+	def send_error(self, output, rid, code, message, data=None):
+		error = {"code": code, "message": message}
+		if data != None:
+			error["data"] = data
+		self.send(output, {"id": rid, "error": error})
+
+	async def handle(self, line, output):
+		try:
+			request = json.loads(line)
+		except json.decoder.JSONDecodeError as e:
+			self.send_error(output, None, -32700, "Parse error: %s"%e)
+			return
+		rid = request.get("id") if isinstance(request, dict) else None
+		if not isinstance(request, dict) or not request.get("method") in methods:
+			self.send_error(output, rid, -32601, "Method not found, should be one of %s"%list(methods))
+			return
+		params = request.get("params", {})
+		if not isinstance(params, dict) or not isinstance(params.get("mapdir"), str):
+			self.send_error(output, rid, -32602, "Invalid params, mapdir is required")
+			return
+		step = params.get("step")
+		if request["method"] == "autocliff" and step != None and (isinstance(step, bool) or not isinstance(step, (int, float))):
+			self.send_error(output, rid, -32602, "Invalid params, step must be a number")
+			return
+		mapdir = os.path.abspath(params["mapdir"])
+		start = time.perf_counter()
+		loop = asyncio.get_running_loop()
+		try:
+			result, log, timings = await loop.run_in_executor(self.get_worker(mapdir), run_request, request["method"], mapdir, params)
+		except Exception as e:
+			self.send_error(output, rid, -32603, "Internal error: %s"%e)
+			return
+		timings["total"] = time.perf_counter() - start
+		if result == None:
+			self.send_error(output, rid, -32000, "%s failed for %s"%(request["method"], mapdir), {"log": log, "timings": timings})
+			return
+		result["log"] = log
+		result["timings"] = timings
+		self.send(output, {"id": rid, "result": result})
+
+	async def serve_lines(self, reader, output):
+		"""Handle each line from reader as a request, without waiting for the previous ones"""
+		tasks = set()
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			if not line.strip():
+				continue
+			task = asyncio.ensure_future(self.handle(line, output))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+		if tasks:
+			await asyncio.wait(tasks)
+
+
+async def serve_stdio(server, output):
+	loop = asyncio.get_running_loop()
+	reader = asyncio.StreamReader()
+	await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+	await server.serve_lines(reader, output)
+
+async def serve_socket(server, path):
+	async def on_client(reader, writer):
+		try:
+			await server.serve_lines(reader, lambda s: writer.write(s.encode()))
+			await writer.drain()
+		finally:
+			writer.close()
+	unix_server = await asyncio.start_unix_server(on_client, path)
+	print("Listening on %s"%path, file=sys.stderr)
+	async with unix_server:
+		await unix_server.serve_forever()
+
+def main():
+	workers = default_workers
+	cache = default_cache_size
+	socket_path = None
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == "--workers" and args:
+			workers = int(args.pop(0))
+		elif arg == "--cache" and args:
+			cache = int(args.pop(0))
+		elif arg == "--socket" and args:
+			socket_path = args.pop(0)
+		else:
+			print("Usage:", file=sys.stderr)
+			print("	wzmapserver.py [--workers count=%d] [--cache maps per worker=%d] [--socket path]"%(default_workers, default_cache_size), file=sys.stderr)
+			exit()
+	server = CompileServer(workers, cache)
+	try:
+		if socket_path:
+			asyncio.run(serve_socket(server, socket_path))
+		else:
+			stdout = sys.stdout
+			def output(s):
+				stdout.write(s)
+				stdout.flush()
+			sys.stdout = sys.stderr
+			asyncio.run(serve_stdio(server, output))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.shutdown()
+
+if __name__ == "__main__":
+	main()